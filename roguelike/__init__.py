@@ -1,35 +1,25 @@
 from __future__ import annotations
-import os
 import enum
 import time
 import random
 import logging
 import dataclasses as dc
-from math import ceil
 from typing import Any, Callable, List, Optional, Tuple, Union
 
 import pyglet
+from pyglet.gl import GL_COLOR_BUFFER_BIT, glClear, glLoadIdentity, glLoadMatrixf
 from pyglet.window import key
 
+from ._bootstrap import PROFILE
+# re-exported, these used to be defined here and are still reachable as roguelike.DIR_*
+from ._bootstrap import DIR_ROOT, DIR_RES # pylint: disable=unused-import
 from .map import Map, Tileset
 from .entity import ActionMove, Player
 
-LOG_FORMAT = logging.Formatter("%(asctime)s [%(levelname)s]: %(message)s")#, "%Y-%m-%d %H:%M:%S")
 LOGGER = logging.getLogger(__name__)
-LOGGER.setLevel(logging.DEBUG)
-TH = logging.StreamHandler()
-TH.setLevel(logging.DEBUG)
-TH.setFormatter(LOG_FORMAT)
-LOGGER.addHandler(TH)
-
-# add resource folder to resources, register it as font directory
-DIR_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-DIR_RES = os.path.join(DIR_ROOT, "res")
-pyglet.font.add_directory(DIR_RES)
-pyglet.resource.path = [DIR_RES]
-pyglet.resource.reindex()
 
 UPDATE_INTERVAL = 1/60
+FRAME_SAMPLES = 64
 
 
 @enum.unique
@@ -58,6 +48,9 @@ KEY_TO_DIR = {
     key.NUM_2: Directions.DOWN,
     key.NUM_1: Directions.LEFT_DOWN,
 }
+# ActionMove holds no per-entity state, so a single instance per direction is shared
+MOVE_ACTIONS = {d.value: ActionMove(*d.value) for d in Directions}
+KEY_TO_MOVE = {k: MOVE_ACTIONS[d.value] for k, d in KEY_TO_DIR.items()}
 
 
 
@@ -67,20 +60,34 @@ class GameWindow(pyglet.window.Window): # pylint: disable=abstract-method
     """
     def __init__(self, *args: int, tileset: Tileset, **kwargs: Any) -> None:
         super().__init__(*args, **kwargs)
-        self.grp_back = pyglet.graphics.OrderedGroup(0)
-        self.grp_fore = pyglet.graphics.OrderedGroup(1)
-        self.grp_ui = pyglet.graphics.OrderedGroup(2)
+        # draw order between tiles, entities and gui comes from drawing their batches in turn
+        self.grp_fore = pyglet.graphics.OrderedGroup(0)
+        self.grp_ui = pyglet.graphics.OrderedGroup(1)
         self.view_target = self.width // 2, self.height // 2
-
+        # distance from the view origin to the corner of the centered tile, updated in on_resize
+        self.view_offset = (self.width // 2 - tileset.tile_width // 2,
+                            self.height // 2 - tileset.tile_height // 2)
+        # modelview matrix translating the grid by -view_target, updated in move_view
+        self.view_matrix = (pyglet.gl.GLfloat * 16)(
+            1, 0, 0, 0,
+            0, 1, 0, 0,
+            0, 0, 1, 0,
+            -self.view_target[0], -self.view_target[1], 0, 1,
+        )
 
         self.player = Player(pyglet.sprite.Sprite(tileset.get_image(6, 0)))
         self.gui = GUI(self)
         self.grid = Map((100, 100), self.player, self, tileset)
+        # bound once, on_draw runs every frame
+        self._draw_tiles = self.grid.tile_batch.draw
+        self._draw_entities = self.grid.batch.draw
+        self._draw_gui = self.gui.batch.draw
 
         self.key_handler = pyglet.window.key.KeyStateHandler()
 
         self.entities = self.grid.entities
-        pyglet.clock.schedule_interval(self.update, UPDATE_INTERVAL)
+        # update is only scheduled while the player has an action to repeat
+        self.ticking = False
 
 
     def update(self, delta: float) -> None:
@@ -91,61 +98,80 @@ class GameWindow(pyglet.window.Window): # pylint: disable=abstract-method
         if not action_successful:
             return
 
-        for entity in self.entities:
-            if entity.action:
-                entity.action(self, entity)
+        self.grid.update_entities(self)
 
 
     def on_draw(self) -> None:
-        self.clear()
-        pyglet.gl.glLoadIdentity() # resets any applied translation matrices
-        pyglet.gl.glPushMatrix() # stash the current matrix so next translation doesn't affect it
-        pyglet.gl.glTranslatef(-self.view_target[0], -self.view_target[1], 0)
-        self.grid.batch.draw()
-        pyglet.gl.glPopMatrix() # retrieve to stashed matrix
-        self.gui.batch.draw()
+        # tiles don't cover the whole window, but nothing uses the depth buffer,
+        # so only the color buffer is cleared
+        glClear(GL_COLOR_BUFFER_BIT)
+        glLoadMatrixf(self.view_matrix)
+        self._draw_tiles()
+        self._draw_entities()
+        glLoadIdentity() # gui is drawn in window coordinates
+        self._draw_gui()
 
 
-    def move_view(self, target: Tuple[int, int]) -> None:
+    def move_view(self, col: int, row: int) -> None:
         """Move the 'view' (center of the screen) to target tile."""
-        abs_x, abs_y = target
-        abs_x *= self.grid.tileset.tile_width
-        abs_y *= self.grid.tileset.tile_height
-        target_x = abs_x - (self.width // 2) + (self.grid.tileset.tile_width // 2)
-        target_y = abs_y - (self.height // 2) + (self.grid.tileset.tile_height // 2)
+        grid = self.grid
+        target_x = col * grid.tile_width - self.view_offset[0]
+        target_y = row * grid.tile_height - self.view_offset[1]
         # view_target is a tuple of offsets from grid origin point
         self.view_target = target_x, target_y
+        self.view_matrix[12] = -target_x
+        self.view_matrix[13] = -target_y
+        grid.update_view(target_x, target_y, self.width, self.height)
 
 
     def on_resize(self, width: int, height: int) -> None:
         super().on_resize(width, height)
-        LOGGER.debug("The window was resized to %dx%d", width, height)
-        assert self.player.occupied_tile, "Player position not set!"
-        self.move_view(self.player.occupied_tile)
+        if __debug__ and LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("The window was resized to %dx%d", width, height)
+        assert self.player.col >= 0, "Player position not set!"
+        self.view_offset = (width // 2 - self.grid.tile_width // 2,
+                            height // 2 - self.grid.tile_height // 2)
+        self.move_view(self.player.col, self.player.row)
 
 
     def on_key_press(self, symbol: int, modifiers: int) -> None:
-        LOGGER.debug("Key pressed %d", symbol)
-        move = KEY_TO_DIR.get(symbol)
+        if __debug__ and LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("Key pressed %d", symbol)
+        move = KEY_TO_MOVE.get(symbol)
         if move:
-            move_x, move_y = move.value
-            self.player.action = ActionMove(move_x, move_y)
+            self.player.action = move
             self.player.movement_repeat_key = symbol
+            self.start_ticking()
 
 
     def on_key_release(self, symbol: int, modifiers: int) -> None:
-        LOGGER.debug("Key released %d", symbol)
+        if __debug__ and LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("Key released %d", symbol)
         if isinstance(self.player.action, ActionMove) and \
            self.player.movement_repeat_key == symbol:
             self.player.action = None
+            self.stop_ticking()
+
+
+    def start_ticking(self) -> None:
+        if not self.ticking:
+            pyglet.clock.schedule_interval(self.update, UPDATE_INTERVAL)
+            self.ticking = True
+
+
+    def stop_ticking(self) -> None:
+        if self.ticking:
+            pyglet.clock.unschedule(self.update)
+            self.ticking = False
 
 
     def on_deactivate(self) -> None:
-        pyglet.clock.unschedule(self.update)
+        self.stop_ticking()
 
 
     def on_activate(self) -> None:
-        pyglet.clock.schedule_interval(self.update, UPDATE_INTERVAL)
+        if self.player.action:
+            self.start_ticking()
 
 
 
@@ -165,9 +191,9 @@ class GUI:
             batch=self.batch, group=self.window.grp_ui
         )
 
-        if __debug__:
-            # emable fps and draw time measurements
-            # this code will only fire when the module is ran without optimization flags
+        if PROFILE:
+            # enable fps and draw time measurements
+            # only when ROGUELIKE_PROFILE is set and the module is ran without optimization flags
             self.fps_label = pyglet.text.Label(
                 text="00.00",
                 font_name="monogram",
@@ -187,23 +213,35 @@ class GUI:
                 batch=self.batch, group=self.window.grp_ui
             )
 
-            self.frame_times: List[float] = []
+            # draw times of the last FRAME_SAMPLES frames in nanoseconds, and their running sum
+            self.frame_times = [0] * FRAME_SAMPLES
+            self.frame_time_sum = 0
+            self.frame_count = 0
             def measure_draw_time(f: Callable) -> Callable:
                 def inner(*args: Any, **kwargs: Any) -> Any:
-                    t0 = time.time()
+                    t0 = time.perf_counter_ns()
                     ret = f(*args, **kwargs)
-                    self.frame_times.append(time.time() - t0)
+                    draw_time = time.perf_counter_ns() - t0
+                    index = self.frame_count % FRAME_SAMPLES
+                    # the oldest sample is replaced, so its time leaves the sum
+                    self.frame_time_sum += draw_time - self.frame_times[index]
+                    self.frame_times[index] = draw_time
+                    self.frame_count += 1
                     return ret
 
                 return inner
 
 
             def check_fps(_: float) -> None:
-                self.fps_label.text = f"{float(pyglet.clock.get_fps()):0>4.2f} updates/s"
-                if self.frame_times:
-                    draw_time_ms = float(sum(self.frame_times) / len(self.frame_times)) * 1000
-                    self.draw_time_label.text = f"{draw_time_ms:0>6.2f} ms/draw"
-                    self.frame_times = []
+                # setting label text lays the glyphs out again, so skip it if nothing changed
+                fps_text = format(pyglet.clock.get_fps(), "0>4.2f") + " updates/s"
+                if fps_text != self.fps_label.text:
+                    self.fps_label.text = fps_text
+                if self.frame_count:
+                    draw_time_ms = self.frame_time_sum / min(self.frame_count, FRAME_SAMPLES) / 1_000_000
+                    draw_time_text = format(draw_time_ms, "0>6.2f") + " ms/draw"
+                    if draw_time_text != self.draw_time_label.text:
+                        self.draw_time_label.text = draw_time_text
 
 
             self.check_fps = check_fps
@@ -0,0 +1,39 @@
+"""Process-wide setup for the package: logging and the resource directory.
+
+The setup runs only once, even if the module gets executed again
+(importlib.reload, tests), so handlers are not attached twice and the
+resource directory is not rescanned.
+"""
+import os
+import logging
+
+import pyglet
+
+LOG_FORMAT = logging.Formatter("%(asctime)s [%(levelname)s]: %(message)s")#, "%Y-%m-%d %H:%M:%S")
+DIR_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+DIR_RES = os.path.join(DIR_ROOT, "res")
+# debug output and draw time measurements are opt-in through the environment
+# (unset, empty or "0" means off), and never enabled when running with
+# optimization flags (python -O)
+DEBUG = __debug__ and os.environ.get("ROGUELIKE_DEBUG", "") not in ("", "0")
+PROFILE = __debug__ and os.environ.get("ROGUELIKE_PROFILE", "") not in ("", "0")
+if DEBUG:
+    LOG_LEVEL = logging.DEBUG
+elif __debug__:
+    LOG_LEVEL = logging.INFO
+else:
+    LOG_LEVEL = logging.WARNING
+
+if not globals().get("_initialized"):
+    LOGGER = logging.getLogger(__package__)
+    LOGGER.setLevel(LOG_LEVEL)
+    TH = logging.StreamHandler()
+    TH.setLevel(LOG_LEVEL)
+    TH.setFormatter(LOG_FORMAT)
+    LOGGER.addHandler(TH)
+
+    # add resource folder to resources, register it as font directory
+    pyglet.font.add_directory(DIR_RES)
+    pyglet.resource.path = [DIR_RES]
+    pyglet.resource.reindex()
+    _initialized = True
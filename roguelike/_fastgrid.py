@@ -0,0 +1,163 @@
+"""Tile predicates and move kernels working directly on the Map's planes.
+
+The functions here only ever touch plain ndarrays and ints, so they can be
+compiled with numba when it is available. Without numba they run as
+regular python functions. try_move is replaced by the version from the
+_fastmove cython extension if it has been built.
+"""
+import numpy as np
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    def njit(*args, **kwargs): # type: ignore
+        """Stand-in for numba.njit, returns the function unchanged."""
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+
+@njit(cache=True)
+def can_move_to(walkable: np.ndarray, entity_ids: np.ndarray, col: int, row: int) -> bool:
+    max_row, max_col = walkable.shape
+    if col >= max_col or row >= max_row or col < 0 or row < 0:
+        return False
+
+    return bool(walkable[row, col]) and entity_ids[row, col] < 0
+
+
+@njit(cache=True)
+def try_move(walkable: np.ndarray, entity_ids: np.ndarray,
+             col: int, row: int, dx: int, dy: int) -> bool:
+    """Move the entity id from (col, row) to (col+dx, row+dy)
+    if the target tile is in bounds, walkable and not occupied.
+    """
+    target_col = col + dx
+    target_row = row + dy
+    max_row, max_col = walkable.shape
+    if target_col >= max_col or target_row >= max_row or target_col < 0 or target_row < 0:
+        return False
+
+    if not walkable[target_row, target_col] or entity_ids[target_row, target_col] >= 0:
+        return False
+
+    entity_ids[target_row, target_col] = entity_ids[row, col]
+    entity_ids[row, col] = -1
+    return True
+
+
+# can_move_to_many and resolve_moves come in two versions: explicit loops
+# for numba, and vectorized numpy otherwise. The numpy versions can't simply
+# be njit-compiled, as numba supports neither np.add.at nor fancy indexing
+# with more than one index array. Their docstrings are set once, below.
+if HAVE_NUMBA:
+    @njit(cache=True)
+    def can_move_to_many(walkable: np.ndarray, entity_ids: np.ndarray,
+                         cols: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        max_row, max_col = walkable.shape
+        free = np.zeros(cols.shape[0], dtype=np.bool_)
+        for i in range(cols.shape[0]):
+            col = cols[i]
+            row = rows[i]
+            if col < 0 or row < 0 or col >= max_col or row >= max_row:
+                continue
+            free[i] = walkable[row, col] and entity_ids[row, col] < 0
+        return free
+
+
+    @njit(cache=True)
+    def resolve_moves(walkable: np.ndarray, entity_ids: np.ndarray, claims: np.ndarray,
+                      positions: np.ndarray, moves: np.ndarray) -> np.ndarray:
+        max_row, max_col = walkable.shape
+        count = positions.shape[0]
+        candidate = np.zeros(count, dtype=np.bool_)
+        for i in range(count):
+            if moves[i, 0] == 0 and moves[i, 1] == 0:
+                continue
+            col = positions[i, 0] + moves[i, 0]
+            row = positions[i, 1] + moves[i, 1]
+            if col < 0 or row < 0 or col >= max_col or row >= max_row:
+                continue
+            if walkable[row, col] and entity_ids[row, col] < 0:
+                candidate[i] = True
+                claims[row, col] += 1
+
+        accepted = candidate.copy()
+        for i in range(count):
+            if candidate[i]:
+                col = positions[i, 0] + moves[i, 0]
+                row = positions[i, 1] + moves[i, 1]
+                if claims[row, col] > 1:
+                    accepted[i] = False
+
+        for i in range(count):
+            if candidate[i]:
+                claims[positions[i, 1] + moves[i, 1], positions[i, 0] + moves[i, 0]] = 0
+        return accepted
+else:
+    def can_move_to_many(walkable: np.ndarray, entity_ids: np.ndarray,
+                         cols: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        max_row, max_col = walkable.shape
+        free = (cols >= 0) & (cols < max_col) & (rows >= 0) & (rows < max_row)
+        # clip so that out-of-bounds tiles can still be used as indices
+        cols = np.clip(cols, 0, max_col - 1)
+        rows = np.clip(rows, 0, max_row - 1)
+        free &= walkable[rows, cols] & (entity_ids[rows, cols] < 0)
+        return free
+
+
+    def resolve_moves(walkable: np.ndarray, entity_ids: np.ndarray, claims: np.ndarray,
+                      positions: np.ndarray, moves: np.ndarray) -> np.ndarray:
+        max_row, max_col = walkable.shape
+        proposed = positions + moves
+        cols = proposed[:, 0]
+        rows = proposed[:, 1]
+        accepted = moves.any(axis=1) & (cols >= 0) & (cols < max_col) & (rows >= 0) & (rows < max_row)
+        # clip so that rejected out-of-bounds moves can still be used as indices
+        np.clip(cols, 0, max_col - 1, out=cols)
+        np.clip(rows, 0, max_row - 1, out=rows)
+        accepted &= walkable[rows, cols] & (entity_ids[rows, cols] < 0)
+
+        np.add.at(claims, (rows[accepted], cols[accepted]), 1)
+        candidate = accepted.copy()
+        accepted &= claims[rows, cols] == 1
+        claims[rows[candidate], cols[candidate]] = 0
+        return accepted
+
+
+can_move_to_many.__doc__ = """Return a mask of the (cols[i], rows[i]) tiles which are
+    in bounds, walkable and not occupied.
+    """
+resolve_moves.__doc__ = """Return a mask of the moves which can be made this turn.
+
+    positions holds (col, row) and moves holds (dx, dy) of each entity.
+    A move is rejected if it leads out of bounds, onto a tile which is
+    not walkable or occupied, or onto a tile another entity is moving to.
+    claims is a zeroed uint8 plane of the map's shape, used as scratch
+    space and zeroed again before returning.
+    """
+
+
+try:
+    from ._fastmove import try_move # type: ignore # pylint: disable=unused-import
+except ImportError:
+    pass
+
+
+def warm_up() -> None:
+    """Call the functions once with the argument types used by Map,
+    so that numba compiles them now rather than on the first move.
+    """
+    walkable = np.ones((2, 2), dtype=bool)
+    entity_ids = np.full((2, 2), -1, dtype=np.int32)
+    can_move_to(walkable, entity_ids, 0, 0)
+    can_move_to_many(walkable, entity_ids, np.zeros(1, dtype=np.intp), np.zeros(1, dtype=np.intp))
+    try_move(walkable, entity_ids, 0, 0, 1, 0)
+    resolve_moves(walkable, entity_ids, np.zeros((2, 2), dtype=np.uint8),
+                  np.zeros((1, 2), dtype=np.int32), np.ones((1, 2), dtype=np.int8))
+
+
+if HAVE_NUMBA:
+    warm_up()
@@ -0,0 +1,28 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""Compiled version of _fastgrid.try_move.
+
+Build in place with `cythonize -i roguelike/_fastmove.pyx`. When the
+extension is not built, the implementation from _fastgrid is used instead.
+"""
+import numpy as np
+
+
+cdef bint _try_move(const unsigned char[:, :] walkable, int[:, :] entity_ids,
+                    int col, int row, int dx, int dy):
+    cdef int target_col = col + dx
+    cdef int target_row = row + dy
+    if target_col < 0 or target_row < 0 \
+       or target_row >= walkable.shape[0] or target_col >= walkable.shape[1]:
+        return False
+
+    if not walkable[target_row, target_col] or entity_ids[target_row, target_col] >= 0:
+        return False
+
+    entity_ids[target_row, target_col] = entity_ids[row, col]
+    entity_ids[row, col] = -1
+    return True
+
+
+def try_move(walkable, entity_ids, int col, int row, int dx, int dy):
+    # the bool array has to be viewed as bytes to match the typed memoryview
+    return _try_move(walkable.view(np.uint8), entity_ids, col, row, dx, dy)
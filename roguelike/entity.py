@@ -1,45 +1,56 @@
 from __future__ import annotations
 
 import logging
-from dataclasses import dataclass
-from typing import Union, Optional, Tuple, TYPE_CHECKING
+from typing import Optional, TYPE_CHECKING
 
 import pyglet
+import numpy as np
 if TYPE_CHECKING:
     from . import GameWindow
 
 LOGGER = logging.getLogger(__name__)
 
+# (dx, dy) of each direction id, in the order of roguelike.Directions; 0 means no movement
+DIRECTION_DELTAS = np.array(
+    ((0, 0), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1)), dtype=np.int8)
+DELTA_TO_DIRECTION = {delta: i for i, delta in enumerate(map(tuple, DIRECTION_DELTAS.tolist()))}
+
 
 class Action:
+    __slots__ = ()
+
     def __call__(self, window: GameWindow, entity: Entity) -> bool:
         raise NotImplementedError()
 
 
 
-@dataclass
 class ActionMove(Action):
-    dx: int
-    dy: int
+    __slots__ = ("dx", "dy", "direction")
+
+    def __init__(self, dx: int, dy: int) -> None:
+        self.dx = dx
+        self.dy = dy
+        self.direction = DELTA_TO_DIRECTION[(dx, dy)]
+
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(dx={self.dx}, dy={self.dy})"
+
 
     def __call__(self, window: GameWindow, entity: Entity) -> bool:
-        assert entity.occupied_tile
-        target_col, target_row = entity.occupied_tile
-        target_col += self.dx
-        target_row += self.dy
-
-        if window.grid.can_move_to(entity, target_col, target_row):
-            window.grid.level_grid["entity"][entity.occupied_tile[::-1]] = 0
-            window.grid.place_entity(entity, target_col, target_row)
-            window.move_view(entity.occupied_tile)
+        if window.grid.move_entity(entity, self.dx, self.dy):
+            window.move_view(entity.col, entity.row)
             return True
 
-        LOGGER.debug("Cannot move entity '%s' to (%d,%d)", entity.name, target_col, target_row)
+        if __debug__ and LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("Cannot move entity '%s' by (%d,%d)", entity.name, self.dx, self.dy)
         return False
 
 
 
 class ActionEsc(Action):
+    __slots__ = ()
+
     def __call__(self, window: GameWindow, entity: Entity) -> bool:
         window.close()
         return True
@@ -56,15 +67,23 @@ class ActionEsc(Action):
 
 
 class Entity:
-    def __init__(self, name: str, sprite: pyglet.sprite.Sprite):
+    __slots__ = ("name", "sprite", "col", "row", "action", "entity_id")
+
+    def __init__(self, name: str, sprite: Optional[pyglet.sprite.Sprite]):
         self.name = name
         self.sprite = sprite
-        self.occupied_tile: Union[Tuple[int, int], Tuple[()]] = ()
+        # occupied tile, -1 while the entity is not placed on the grid
+        self.col = -1
+        self.row = -1
         self.action: Optional[Action] = None
+        # index in Map.entity_table, assigned when the entity is first placed
+        self.entity_id = -1
 
 
 
 class Player(Entity):
+    __slots__ = ("movement_repeat_key",)
+
     def __init__(self, sprite: pyglet.sprite.Sprite) -> None:
         super().__init__("player", sprite)
         self.movement_repeat_key: Optional[int] = None
@@ -1,16 +1,13 @@
 import time
-import random
 import logging
-from dataclasses import dataclass
 from typing import Dict, List, Optional, Tuple, Union
 import pyglet
 import numpy as np
 
-from.entity import Entity
+from.entity import DIRECTION_DELTAS, Action, ActionMove, Entity
+from . import _fastgrid
 
 
-#TODO: Delay creation of tile sprites
-#TODO: use a sprite pool, assign sprites to tiles as needed
 #FIXME: fix coordinate issue resulting from indexing discrepency between pyglet and numpy
 #   numpy  [0,0] = top left
 #   pyglet [0,0] = bottom left
@@ -19,26 +16,15 @@ from.entity import Entity
 
 LOGGER = logging.getLogger(__name__)
 
-DT_TILE_GRAPHIC = np.dtype([
-        ("sprite", pyglet.sprite.Sprite),
-        ("active", bool),   # whether this sprite has been initialized and can be displayed
-    ]
-)
-DT_TILE_NAV = np.dtype([
-        ("walkable", bool),          # True if this tile can be walked over
-        ("transparent", bool),       # True if this tile doesn't block FOV
-        ("sprite", DT_TILE_GRAPHIC), #
-        ("entity", Entity),          # entity occupying the tile
-    ]
-)
 
-
-def random_rgb() -> Tuple[int, int, int]:
-    return (
-        random.randrange(0,256),
-        random.randrange(0,256),
-        random.randrange(0,256),
-    )
+def _outside_rect(rows: np.ndarray, cols: np.ndarray,
+                  bounds: Tuple[int, int, int, int]) -> np.ndarray:
+    """Return a (len(rows), len(cols)) mask of the tiles which are outside
+    of the rectangle given as (col_min, col_max, row_min, row_max).
+    """
+    col_min, col_max, row_min, row_max = bounds
+    return ((rows < row_min) | (rows >= row_max))[:, None] \
+         | ((cols < col_min) | (cols >= col_max))[None, :]
 
 
 
@@ -49,21 +35,116 @@ class Tileset:
         self.cols = cols
 
         self._image_grid = pyglet.image.ImageGrid(pyglet.image.load(path), rows, cols)
-        self._num_to_img: Dict[int, pyglet.image.AbstractImage] = {}
+        # upload the tileset as a single texture so that all its images share one texture
+        self._texture_grid = pyglet.image.TextureGrid(self._image_grid)
+        # image regions by tile id (row * cols + col); the grid already holds them in that order
+        # a plain list, as images are only ever looked up one at a time
+        self.images_flat = list(self._texture_grid)
+        # texture coordinates of every image (12 floats, one (u, v, r) per corner),
+        # indexed [row, col] in tex_coords and by tile id in tex_coords_flat
+        self.tex_coords_flat = np.array(
+            [image.tex_coords for image in self.images_flat], dtype=np.float32)
+        self.tex_coords = self.tex_coords_flat.reshape(rows, cols, 12)
 
         self.scale = scale
-        self.tile_width = self._image_grid.item_height * scale
+        self.tile_width = self._image_grid.item_width * scale
         self.tile_height = self._image_grid.item_height * scale
 
 
     def get_image(self, row: int, col: int) -> pyglet.image.AbstractImage:
-        img = self._num_to_img.get(row * col)
-        if img:
-            return img
+        return self.images_flat[row * self.cols + col]
+
+
+    def get_image_by_id(self, tile_id: int) -> pyglet.image.AbstractImage:
+        return self.images_flat[tile_id]
+
+
+    def get_tile_id(self, row: int, col: int) -> int:
+        return row * self.cols + col
+
+
+
+class TileMesh:
+    """Set of textured quads stored in a single vertex list.
+
+    Used for the tiles in view and for npcs instead of one sprite each. Quads
+    (slots) are handed out with acquire(), repositioned with move() and hidden
+    again with release(), all of which handle any number of quads with a single
+    write per vertex attribute.
+    """
+    def __init__(self, image: pyglet.image.AbstractImage, batch: pyglet.graphics.Batch,
+                 group: pyglet.graphics.Group, size: int, scale: int = 1) -> None:
+        texture = image.get_texture()
+        # same state as the tileset's sprites, so the group can be shared with them
+        self.group = pyglet.sprite.SpriteGroup(
+            texture, pyglet.gl.GL_SRC_ALPHA, pyglet.gl.GL_ONE_MINUS_SRC_ALPHA, group)
+        self.quad_width = image.width * scale
+        self.quad_height = image.height * scale
+        self.vertex_list = batch.add(
+            size * 4, pyglet.gl.GL_QUADS, self.group, "v2i/dynamic", "t3f/dynamic", "c4B/static")
+        self.size = 0
+        self._free: List[int] = []
+        self.reserve(size)
+
+
+    def _quads(self, attribute: str, components: int) -> np.ndarray:
+        """Return an array view of a vertex attribute, one row per quad.
+        Accessing the attribute marks its whole buffer region as changed.
+        """
+        array = np.ctypeslib.as_array(getattr(self.vertex_list, attribute))
+        return array.reshape(-1, components * 4)
 
-        img = self._image_grid[row, col]
-        self._num_to_img[row * col] = img
-        return img
+
+    def reserve(self, size: int) -> None:
+        """Grow the vertex list until it holds at least size quads."""
+        if size <= self.size:
+            return
+
+        if size * 4 != self.vertex_list.get_size():
+            self.vertex_list.resize(size * 4)
+        self._quads("vertices", 2)[self.size:] = 0
+        self._quads("colors", 4)[self.size:] = 255
+        self._free.extend(range(size - 1, self.size - 1, -1))
+        self.size = size
+
+
+    def acquire(self, xs: np.ndarray, ys: np.ndarray,
+                tex_coords: np.ndarray, colors: Optional[np.ndarray] = None) -> np.ndarray:
+        """Show a quad at each (xs[i], ys[i]) position, textured with tex_coords
+        and tinted with colors. tex_coords is either a single row of 12 floats
+        or one row per quad, colors a single (r, g, b) or one per quad. Without
+        colors the quads keep their current color, white unless a slot was tinted
+        before, so a mesh should either always or never be given colors.
+        Return the slots of the quads, to be passed to release() later.
+        """
+        count = len(xs)
+        if not count:
+            return np.empty(0, dtype=np.intp)
+
+        if count > len(self._free):
+            self.reserve(self.size + count - len(self._free))
+
+        slots = np.array(self._free[-count:], dtype=np.intp)
+        del self._free[-count:]
+        self.move(slots, xs, ys)
+        self._quads("tex_coords", 3)[slots] = tex_coords
+        if colors is not None:
+            # alpha is left at 255, as set in reserve()
+            self._quads("colors", 4).reshape(-1, 4, 4)[slots, :, :3] = np.asarray(colors)[..., None, :]
+        return slots
+
+
+    def move(self, slots: np.ndarray, xs: np.ndarray, ys: np.ndarray) -> None:
+        """Move the quads in slots to the (xs[i], ys[i]) positions."""
+        x2 = xs + self.quad_width
+        y2 = ys + self.quad_height
+        self._quads("vertices", 2)[slots] = np.stack((xs, ys, x2, ys, x2, y2, xs, y2), axis=1)
+
+
+    def release(self, slots: np.ndarray) -> None:
+        """Hide the quads in slots and make them available again."""
+        self._quads("vertices", 2)[slots] = 0
+        self._free.extend(slots.tolist())
 
 
 
@@ -73,20 +154,40 @@ class Map:
                 ) -> None:
         self.window = window
         self.tileset = tileset
-        self.batch = pyglet.graphics.Batch()
-        self.grp_tiles = pyglet.graphics.OrderedGroup(1, self.window.grp_fore)
-        self.grp_entities = pyglet.graphics.OrderedGroup(2, self.window.grp_fore)
-
-        self.level_grid = np.empty((size[1], size[0]), dtype=DT_TILE_NAV)
+        # copied from the tileset, as they are read on every view update
+        self.tile_width = tileset.tile_width
+        self.tile_height = tileset.tile_height
+        self.batch = pyglet.graphics.Batch()      # entities
+        self.tile_batch = pyglet.graphics.Batch() # tiles in view, drawn before entities
+        self.view_bounds = (0, 0, 0, 0)           # visible tiles: col_min, col_max, row_min, row_max
+        # tiles and entities come from the same texture, so their sprites share one
+        # sprite group; entities are drawn above tiles because tile_batch is drawn first
+        self.grp_sprites = self.window.grp_fore
+
+        # tile data is kept as separate planes (structure of arrays), all indexed [row, col]
+        shape = (size[1], size[0])
+        self.shape = shape
+        self.walkable = np.empty(shape, dtype=bool)      # True if this tile can be walked over
+        self.transparent = np.empty(shape, dtype=bool)   # True if this tile doesn't block FOV
+        self.tile_ids = np.empty(shape, dtype=np.int32)  # tileset image of the tile, see Tileset.get_tile_id
+        self.tile_slots = np.empty(shape, dtype=np.intp) # slot in tile_mesh, -1 if not displayed
+        self.sprite_active = np.empty(shape, dtype=bool) # whether the tile is displayed
+        self.entity_ids = np.empty(shape, dtype=np.int32) # id of the entity on the tile, -1 if none
+        self._claims = np.zeros(shape, dtype=np.uint8)   # scratch plane for _fastgrid.resolve_moves
+        self.entity_table: List[Entity] = [] # every entity placed on the map, indexed by id
+        # pixel offset of each column and row from the grid origin
+        self._col_to_x = np.arange(shape[1], dtype=np.int32) * self.tile_width
+        self._row_to_y = np.arange(shape[0], dtype=np.int32) * self.tile_height
+        self.entities: List[Entity] = []
+        self._npc_index: Dict[int, int] = {} # index in self.entities of each npc, by entity id
+        self._npc_actors: Dict[int, Entity] = {} # npcs with an action other than a move, by entity id
         self.create_grid()
 
         player.sprite.batch = self.batch
-        player.sprite.group = self.grp_entities
+        player.sprite.group = self.grp_sprites
         player.sprite.scale = self.tileset.scale
         self.player = player
         self.place_player()
-
-        self.entities: List[Entity] = []
         self.create_entities()
 
 
@@ -94,101 +195,265 @@ class Map:
         LOGGER.debug("Initializing grid")
 
         t0 = time.time()
-        row_count, col_count = self.level_grid.shape
-        for row in range(row_count):
-            for col in range(col_count):
-                pos_x = self.tileset.tile_width * col + 5
-                pos_y = self.tileset.tile_height * row + 5
-                sprite = pyglet.sprite.Sprite(
-                    self.tileset.get_image(7, 12), x=pos_x, y=pos_y,
-                    batch=self.batch, group=self.grp_tiles
-                )
-                tile = np.array(
-                    (True, True, (sprite, False), 0),
-                    dtype=DT_TILE_NAV
-                )
-                self.level_grid[row][col] = tile
+        self.walkable[:] = True
+        self.transparent[:] = True
+        self.tile_slots[:] = -1
+        self.sprite_active[:] = False
+        self.entity_ids[:] = -1
+
+        # tiles are only given a quad in tile_mesh once they are in view
+        self.tile_x = self._col_to_x + 5
+        self.tile_y = self._row_to_y + 5
+        self.tile_ids[:] = self.tileset.get_tile_id(7, 12)
+        # all tileset images share one texture, so any of them can set up the mesh
+        self.tile_image = self.tileset.get_image(7, 12)
+        # integer ceil division, plus a partially visible tile on each side
+        pool_size = (-(-self.window.width // self.tile_width) + 2) \
+                  * (-(-self.window.height // self.tile_height) + 2)
+        self.tile_mesh = TileMesh(self.tile_image, self.tile_batch, self.grp_sprites, pool_size)
 
         LOGGER.info("Init took %.4f", time.time() - t0)
 
 
-    def create_entities(self) -> None:
-        for i in range(10):
-            rand_x = random.randrange(self.level_grid.shape[0]-1)
-            rand_y = random.randrange(self.level_grid.shape[1]-1)
-            sprite = pyglet.sprite.Sprite(
-                self.tileset.get_image(6, 0), batch=self.batch, group=self.grp_entities)
-            sprite.scale = self.tileset.scale
-            sprite.color = random_rgb()
-            #sprite = Sprite(0, 0, self.sprite_scale, sprite=_sprite, color_norm=_sprite.color)
-            ent = Entity(f"npc{i}", sprite)
-            self.place_entity(ent, rand_x, rand_y)
+    def update_view(self, view_x: int, view_y: int, width: int, height: int) -> None:
+        """Show the tiles within the view rectangle
+        and release the quads of tiles which went out of view.
+        """
+        row_count, col_count = self.shape
+        tile_width = self.tile_width
+        tile_height = self.tile_height
+        col_min = max(0, view_x // tile_width)
+        row_min = max(0, view_y // tile_height)
+        # kept >= the minimum, negative bounds would wrap around when slicing
+        col_max = max(col_min, min(col_count, (view_x + width) // tile_width + 1))
+        row_max = max(row_min, min(row_count, (view_y + height) // tile_height + 1))
+        if (col_min, col_max, row_min, row_max) == self.view_bounds:
+            return
+
+        # only the strips where the old and new view rectangles differ are touched
+        old_bounds = self.view_bounds
+        self.view_bounds = (col_min, col_max, row_min, row_max)
+
+        old_rows = np.arange(old_bounds[2], old_bounds[3])
+        old_cols = np.arange(old_bounds[0], old_bounds[1])
+        leaving = _outside_rect(old_rows, old_cols, self.view_bounds)
+        if leaving.any():
+            view = np.s_[old_bounds[2]:old_bounds[3], old_bounds[0]:old_bounds[1]]
+            old_slots = self.tile_slots[view]
+            self.tile_mesh.release(old_slots[leaving])
+            old_slots[leaving] = -1
+            self.sprite_active[view][leaving] = False
+
+        rows = np.arange(row_min, row_max)
+        cols = np.arange(col_min, col_max)
+        row_index, col_index = np.nonzero(_outside_rect(rows, cols, old_bounds))
+        rows = rows[row_index]
+        cols = cols[col_index]
+        self.tile_slots[rows, cols] = self.tile_mesh.acquire(
+            self.tile_x[cols], self.tile_y[rows],
+            self.tileset.tex_coords_flat[self.tile_ids[rows, cols]])
+        self.sprite_active[rows, cols] = True
+
+
+    def random_free_tiles(self, count: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Pick count distinct walkable and unoccupied tiles at random.
+        Return their columns and rows.
+        """
+        row_count, col_count = self.shape
+        blocked = ~self.free_tiles()
+        assert count <= blocked.size - np.count_nonzero(blocked), "Not enough free tiles"
+        cols = np.empty(count, dtype=np.intp)
+        rows = np.empty(count, dtype=np.intp)
+        pending = np.arange(count)
+        # draw positions for all unplaced entities at once, then redraw the rejected ones
+        while len(pending):
+            new_cols = np.random.randint(0, col_count, size=len(pending))
+            new_rows = np.random.randint(0, row_count, size=len(pending))
+            accepted = ~blocked[new_rows, new_cols]
+            # of several picks of the same tile, only the first one is kept
+            _, first = np.unique(new_rows * col_count + new_cols, return_index=True)
+            unique = np.zeros(len(pending), dtype=bool)
+            unique[first] = True
+            accepted &= unique
+
+            cols[pending[accepted]] = new_cols[accepted]
+            rows[pending[accepted]] = new_rows[accepted]
+            blocked[new_rows[accepted], new_cols[accepted]] = True
+            pending = pending[~accepted]
+
+        return cols, rows
+
+
+    def create_entities(self, count: int = 10) -> None:
+        cols, rows = self.random_free_tiles(count)
+        colors = np.random.randint(0, 256, size=(count, 3), dtype=np.uint8)
+        for i in range(count):
+            # npcs are drawn from entity_mesh, so they have no sprite of their own
+            ent = Entity(f"npc{i}", None)
+            self.place_entity(ent, int(cols[i]), int(rows[i]))
             self.entities.append(ent)
 
+        # positions (col, row), move directions (see set_action) and entity_mesh slots of self.entities, by index
+        self._ent_pos = np.stack((cols, rows), axis=1).astype(np.int32)
+        self._ent_dir = np.zeros(count, dtype=np.int8)
+        self._ent_ids = np.array([ent.entity_id for ent in self.entities], dtype=np.int32)
+        self.entity_mesh = TileMesh(
+            self.tileset.get_image(6, 0), self.batch, self.grp_sprites, count, self.tileset.scale)
+        self._ent_slots = self.entity_mesh.acquire(
+            self._col_to_x[cols], self._row_to_y[rows], self.tileset.tex_coords[6, 0], colors)
+        self._npc_index = {ent.entity_id: i for i, ent in enumerate(self.entities)}
+
+
+    def update_entities(self, window: pyglet.window.Window) -> None:
+        """Perform the actions of all entities other than the player.
+
+        Moves are resolved for all entities at once, see _fastgrid.resolve_moves.
+        """
+        for entity in list(self._npc_actors.values()):
+            entity.action(window, entity)
+
+        directions = self._ent_dir
+        if not directions.any():
+            return
+
+        moves = DIRECTION_DELTAS[directions]
+        accepted = _fastgrid.resolve_moves(
+            self.walkable, self.entity_ids, self._claims, self._ent_pos, moves)
+        # accepted targets were free and distinct, so the planes are updated
+        # in bulk rather than per entity
+        cols = self._ent_pos[accepted, 0]
+        rows = self._ent_pos[accepted, 1]
+        self.entity_ids[rows, cols] = -1
+        self._ent_pos[accepted] += moves[accepted]
+        cols = self._ent_pos[accepted, 0]
+        rows = self._ent_pos[accepted, 1]
+        self.entity_ids[rows, cols] = self._ent_ids[accepted]
+        for i, col, row in zip(np.flatnonzero(accepted).tolist(), cols.tolist(), rows.tolist()):
+            entity = self.entities[i]
+            entity.col = col
+            entity.row = row
+
+        self.entity_mesh.move(self._ent_slots[accepted], self._col_to_x[cols], self._row_to_y[rows])
+
+
+    def set_action(self, entity: Entity, action: Optional[Action]) -> None:
+        """Set the action entity repeats every turn, or clear it with None.
+
+        Npc actions have to be set here rather than on entity.action, so that
+        moves are recorded in _ent_dir and update_entities never has to visit
+        npcs which only move.
+        """
+        entity.action = action
+        i = self._npc_index.get(entity.entity_id)
+        if i is None:
+            return # the player, whose action is performed by the window
+
+        if isinstance(action, ActionMove):
+            self._ent_dir[i] = action.direction
+        else:
+            self._ent_dir[i] = 0
+
+        if action is None or isinstance(action, ActionMove):
+            self._npc_actors.pop(entity.entity_id, None)
+        else:
+            self._npc_actors[entity.entity_id] = entity
+
 
     def place_player(self) -> None:
         self.place_entity(self.player, 24, 13)
 
 
     def place_entity(self, entity: Entity, col: int, row: int) -> None:
-        abs_x = col * self.tileset.tile_width
-        abs_y = row * self.tileset.tile_height
-        LOGGER.debug("Adding entity on: grid(%s,%s) abs(%s,%s)",
-                     col, row, abs_x, abs_y)
-
-        if entity.sprite:
-            entity.sprite.update(x=abs_x, y=abs_y)
+        if entity.entity_id < 0:
+            entity.entity_id = len(self.entity_table)
+            self.entity_table.append(entity)
+
+        assert self.entity_ids[row, col] == -1, "Tile already occupied"
+        self.entity_ids[row, col] = entity.entity_id
+        entity.col = col
+        entity.row = row
+        # npcs being spawned are not in _npc_index yet, create_entities draws them itself
+        if entity.sprite is not None or entity.entity_id in self._npc_index:
+            self._draw_entity_at(entity, col, row)
+
+
+    def _draw_entity_at(self, entity: Entity, col: int, row: int) -> None:
+        """Move the entity's sprite, or the quad of a sprite-less npc, to (col, row).
+        update_entities does the same for all npcs which moved at once.
+        """
+        if entity.sprite is not None:
+            entity.sprite.position = (self._col_to_x[col], self._row_to_y[row])
+            return
+
+        i = self._npc_index[entity.entity_id]
+        self._ent_pos[i] = (col, row)
+        self.entity_mesh.move(
+            self._ent_slots[i:i + 1], self._col_to_x[col:col + 1], self._row_to_y[row:row + 1])
+
+
+    def move_entity(self, entity: Entity, dx: int, dy: int) -> bool:
+        """Move entity by (dx, dy) if the target tile is free. Return True on success."""
+        col = entity.col
+        row = entity.row
+        assert col >= 0
+        if not _fastgrid.try_move(self.walkable, self.entity_ids, col, row, dx, dy):
+            return False
 
-        assert not self.level_grid["entity"][row][col]
-        self.level_grid["entity"][row][col] = entity
-        entity.occupied_tile = (col, row)
+        # the id was already moved on entity_ids by try_move
+        entity.col = col = col + dx
+        entity.row = row = row + dy
+        self._draw_entity_at(entity, col, row)
+        return True
 
 
-    def can_move_to(self, entity: Entity, col: int, row: int) -> bool:
-        max_row, max_col = self.level_grid.shape
-        if col >= max_col or row >= max_row or col < 0 or row < 0:
-            LOGGER.debug("cannot move - out of bounds")
-            return False
+    def entity_at(self, col: int, row: int) -> Optional[Entity]:
+        """Return the entity occupying the tile, or None."""
+        entity_id = self.entity_ids[row, col]
+        if entity_id < 0:
+            return None
 
-        if self.level_grid["entity"][row][col]:
-            LOGGER.debug("cannot move - tile occupied")
-            return False
+        return self.entity_table[entity_id]
 
-        return True
 
+    def can_move_to(self, entity: Entity, col: int, row: int) -> bool:
+        return _fastgrid.can_move_to(self.walkable, self.entity_ids, col, row)
 
 
-@dataclass(init=True, eq=False)
-class TileSprite:
-    x: int
-    y: int
-    scale: Union[float, int] = 1
-    # ~ image:
-    sprite: Optional[pyglet.sprite.Sprite] = None
-    color_norm: Tuple[int,int,int] = (255, 255, 255) # color of the sprite when it is visible
-    color_dark: Tuple[int,int,int] = (128, 128, 128) # uncovered but not visible
+    def free_tiles(self) -> np.ndarray:
+        """Return a mask of the tiles which are walkable and not occupied."""
+        return self.walkable & (self.entity_ids < 0)
 
 
-    def __repr__(self) -> str:
-        return f"<{self.__class__} [{self.x}, {self.y}]>"
+    def can_move_to_many(self, cols: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Return a mask of the (cols[i], rows[i]) tiles an entity could move to,
+        for checking many candidate tiles at once (e.g. when expanding a path).
+        """
+        return _fastgrid.can_move_to_many(self.walkable, self.entity_ids, cols, rows)
 
 
-    # https://github.com/python/mypy/issues/9779
-    @property # type: ignore [no-redef]
-    def sprite(self) -> pyglet.sprite.Sprite: # pylint: disable=function-redefined
-        if not hasattr(self, "_sprite"):
-            self._sprite = None
-        return self._sprite
 
+class TileSprite:
+    __slots__ = ("x", "y", "scale", "sprite", "color_norm", "color_dark")
 
-    @sprite.setter
-    def sprite(self, sprite: pyglet.sprite.Sprite) -> None:
-        """Ensure proper placement when setting the sprite"""
+    def __init__(self, x: int, y: int, scale: Union[float, int] = 1,
+                 sprite: Optional[pyglet.sprite.Sprite] = None,
+                 color_norm: Tuple[int,int,int] = (255, 255, 255), # color of the sprite when it is visible
+                 color_dark: Tuple[int,int,int] = (128, 128, 128), # uncovered but not visible
+                ) -> None:
+        self.x = x
+        self.y = y
+        self.scale = scale
+        self.color_norm = color_norm
+        self.color_dark = color_dark
         if sprite:
-            sprite.update(x=self.x, y=self.y)
-            sprite.color = self.color_norm
+            # place the sprite here once, sprite itself is a plain attribute
+            sprite.update(x=x, y=y)
+            sprite.color = color_norm
+        self.sprite = sprite
+
 
-        self._sprite = sprite
+    def __repr__(self) -> str:
+        return f"<{self.__class__} [{self.x}, {self.y}]>"
 
 
     def activate(self) -> None: